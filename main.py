@@ -1,20 +1,36 @@
 import asyncio
+import hashlib
+import hmac
 import logging
+import os
 import struct
 import serial
 import time
 import platform
+import queue
+import re
+import secrets
+import threading
 import random
 import math
 import json
+import numpy as np
+import orjson
 import uvicorn
+from array import array
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from fastapi import FastAPI, Request, Response, HTTPException, status
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 from contextlib import asynccontextmanager
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Literal, Union
+
+try:
+    from numba import njit # Optional: JIT-compiles the control step on larger deployments
+except ImportError:
+    njit = None
 
 # --- CONFIGURATION ---
 if platform.system() == "Windows":
@@ -24,16 +40,133 @@ else:
 
 BAUD_RATE = 9600
 POLL_RATE = 1.0 
+IDLE_POLL_RATE = 5.0 # Used while every unit is well clear of its setpoints
+SESSION_TTL = 8 * 3600
+MAX_SESSIONS = 100
+
+# --- MODBUS CRC16 (poly 0xA001, reflected) ---
+def _crc16_entry(b):
+    crc = b
+    for _ in range(8):
+        crc = (crc >> 1) ^ 0xA001 if (crc & 1) else (crc >> 1)
+    return crc
+
+CRC16_MODBUS_TABLE = array('H', [_crc16_entry(b) for b in range(256)])
+
+def crc16_modbus(data):
+    crc = 0xFFFF
+    for b in data:
+        crc = (crc >> 8) ^ CRC16_MODBUS_TABLE[(crc ^ b) & 0xFF]
+    return crc
+
+# --- MODBUS WRITE-SINGLE-COIL FRAMES (slave 0xFF, fn 0x05) ---
+_HDR = struct.Struct('>BBHH')
+_CRC = struct.Struct('<H')
+
+def _coil_frame(relay_idx, data):
+    packet = _HDR.pack(0xFF, 0x05, relay_idx, data)
+    return packet + _CRC.pack(crc16_modbus(packet))
+
+# Frames are fixed per relay, so the whole frame (CRC included) is built once
+_RELAY_ON = {i: _coil_frame(i, 0xFF00) for i in range(16)}
+_RELAY_OFF = {i: _coil_frame(i, 0x0000) for i in range(16)}
 
 # --- LOGGING ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s | %(levelname)s | %(message)s')
 logger = logging.getLogger("BAS_Core")
 
 # --- DATA MODELS & STATE ---
+def hash_password(password, salt):
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, 100_000).hex()
+
+def make_user(username, password, role):
+    salt = os.urandom(16)
+    return {"username": username, "hash": hash_password(password, salt), "salt": salt, "role": role}
+
+# Stand-in checked for unknown usernames so a miss costs the same PBKDF2 work as a hit
+_DUMMY_USER = make_user("", os.urandom(16).hex(), "")
+
+def compile_schedule(sched):
+    # Pre-compute minute-of-day bounds so the control loop never parses "HH:MM"
+    for d in sched.get("days", {}).values():
+        try:
+            s_h, s_m = map(int, d["start"].split(":"))
+            e_h, e_m = map(int, d["end"].split(":"))
+            d["_start_min"], d["_end_min"] = s_h * 60 + s_m, e_h * 60 + e_m
+        except (KeyError, ValueError, AttributeError):
+            d["_start_min"] = d["_end_min"] = 0 # Bad format never matches
+    return sched
+
+class UnitArrays:
+    """Structure-of-arrays copy of the per-unit numeric state, in sys.units order.
+
+    The control loop owns the temperatures here between ticks; the unit dicts
+    are refreshed from them by sync_to_units() when the status payload is built,
+    unless the API has written a new temp into the dict since the last sync.
+    """
+    def __init__(self, units):
+        self.ids = list(units)
+        vals = list(units.values())
+        self.synced = {uid: u["temp"] for uid, u in units.items()} # Last temp seen in / written to each dict
+        self.temp = np.array([u["temp"] for u in vals], dtype=np.float64)
+        self.sp_occ_cool = np.array([u["setpoints"]["occ_cool"] for u in vals], dtype=np.float64)
+        self.sp_occ_heat = np.array([u["setpoints"]["occ_heat"] for u in vals], dtype=np.float64)
+        self.sp_unocc_cool = np.array([u["setpoints"]["unocc_cool"] for u in vals], dtype=np.float64)
+        self.sp_unocc_heat = np.array([u["setpoints"]["unocc_heat"] for u in vals], dtype=np.float64)
+        self.out_cool = np.array([bool(u["outputs"]["cool"]) for u in vals], dtype=bool)
+        self.out_heat = np.array([bool(u["outputs"]["heat"]) for u in vals], dtype=bool)
+        self.resid = np.zeros(len(vals)) # Sub-0.1 F remainder carried between steps
+
+    def sync_to_units(self, units):
+        for uid, t in zip(self.ids, self.temp.tolist()):
+            u = units.get(uid)
+            # A changed dict value is an API edit; leave it to win on the next rebuild
+            if u is not None and u["temp"] == self.synced[uid]:
+                u["temp"] = self.synced[uid] = t
+
+def _step(temps, resid, sp_oc, sp_oh, sp_uc, sp_uh, occ, out_cool, out_heat, e_stop, sim_scale):
+    """One physics + control step over all units; updates temps and resid in place.
+
+    resid carries the part of each step lost to the 0.1 F rounding into the next one,
+    so small steps accumulate instead of being rounded away.
+
+    Returns (req_fan, req_cool, req_heat, sp_cool, sp_heat, nearest), where nearest
+    is the closest any unit is to one of its active setpoints.
+    """
+    # B. Physics Simulation
+    raw = temps + resid + (0.05 - 0.3 * out_cool + 0.4 * out_heat) * sim_scale
+    np.round(raw, 1, temps)
+    resid[:] = raw - temps
+
+    # C. Control Logic
+    sp_c = sp_oc if occ else sp_uc
+    sp_h = sp_oh if occ else sp_uh
+    req_cool = temps > sp_c + 1.0
+    req_heat = temps < sp_h - 1.0
+    # Fan logic: On if occupied OR if heating/cooling is needed
+    req_fan = req_cool | req_heat | occ
+    if e_stop:
+        req_cool[:] = False
+        req_heat[:] = False
+        req_fan[:] = False
+    nearest = min(np.abs(temps - sp_c).min(), np.abs(temps - sp_h).min()) if temps.size else np.inf
+    return req_fan, req_cool, req_heat, sp_c, sp_h, nearest
+
+# Fast-math without "arcp"/"reassoc" so the 0.1 F rounding stays bit-identical to NumPy's,
+# and without "ninf" because nearest is np.inf when there are no units
+control_step = njit(cache=True, fastmath={"nnan", "nsz", "contract"}, boundscheck=False)(_step) if njit else _step
+
+def warm_control_step():
+    # Compile ahead of the first real tick so the JIT cost doesn't land on it
+    if not njit: return
+    z = np.zeros(1)
+    control_step(z, z.copy(), z, z, z, z, True, np.zeros(1, dtype=bool), np.zeros(1, dtype=bool), False, 1.0)
+    logger.info("Control step compiled with numba")
+
 class SystemState:
     def __init__(self):
         self.start_time = time.time()
-        self.authenticated_sessions = set()
+        self.authenticated_sessions = OrderedDict() # token -> expiry ts, oldest first
         self.site_config = {
             "name": "Headquarters", 
             "address": "101 Automation Blvd", 
@@ -48,13 +181,13 @@ class SystemState:
             "holidays": {}
         }
         # Credentials
-        self.users = [{"username": "admin", "password": "admin", "role": "admin"}] 
-        self.logs = []
+        self.users = {"admin": make_user("admin", "admin", "admin")}
+        self.logs = deque(maxlen=100)
         self.schedules = {
-            "sch_default": {
+            "sch_default": compile_schedule({
                 "id": "sch_default", "name": "Standard Office", 
                 "days": {i: {"enabled": True, "start": "08:00", "end": "18:00"} for i in range(7)}
-            }
+            })
         }
         
         # Initialize default unit
@@ -66,9 +199,9 @@ class SystemState:
                 "outputs": {"fan": False, "cool": False, "heat": False, "damper": 20},
                 "inputs": {"fan_status": True, "filter_status": True, "alarm_general": False},
                 "overrides": {},
-                "alarms": [], "alarms_enabled": True,
+                "alarms": {}, "alarms_enabled": True,
                 "is_occupied": True, "is_simulating": False,
-                "history": [], 
+                "history": deque(maxlen=60), 
                 "pins": {"fan": 0, "cool": 1, "heat": 2, "damper": 3},
                 "custom_sensors": {}, 
                 "custom_sensor_values": {},
@@ -78,10 +211,31 @@ class SystemState:
             }
         }
         self.global_occupied = True # Default state
+        self.wake = asyncio.Event() # Set by control-affecting API writes to cut an idle sleep short
+        self.status_cache = None # Encoded shared part of /api/status, None = stale
+        self.rev = 0 # Bumped whenever the status payload may have changed; used as its ETag
+        self.boot_id = secrets.token_hex(4) # Keeps ETags from a previous process from matching
+        self.unit_state = None # UnitArrays, rebuilt from the dicts when units_stale is set
+        self.units_stale = True
+
+    def invalidate_status(self):
+        self.status_cache = None
+        self.rev += 1
+
+    def refresh_unit_state(self):
+        # Flush loop-owned temps into unedited dicts first so API edits and sim state both survive
+        prev = self.unit_state
+        if prev: prev.sync_to_units(self.units)
+        self.unit_state = UnitArrays(self.units)
+        if prev:
+            # Keep each surviving unit's rounding remainder across the rebuild
+            old_idx = {uid: i for i, uid in enumerate(prev.ids)}
+            for i, uid in enumerate(self.unit_state.ids):
+                if uid in old_idx: self.unit_state.resid[i] = prev.resid[old_idx[uid]]
+        self.units_stale = False
 
     def add_log(self, type, unit, msg):
-        self.logs.insert(0, {"ts": time.time(), "type": type, "unit": unit, "msg": msg})
-        if len(self.logs) > 100: self.logs.pop()
+        self.logs.appendleft({"ts": time.time(), "type": type, "unit": unit, "msg": msg})
 
 sys = SystemState()
 
@@ -90,37 +244,74 @@ class HexEngine:
     def __init__(self, port, baud):
         self.port = port
         self.baud = baud
+        # Modbus RTU silent interval: 3.5 char times (11 bits/char), fixed 1.75 ms above 19200 baud
+        self.frame_gap = 3.5 * 11 / baud if baud <= 19200 else 0.00175
         self.ser = None
-        self.lock = asyncio.Lock()
+        self.lock = threading.Lock() # Guards self.ser between connect() and the writer thread
+        self.queue = queue.SimpleQueue() # Encoded frames for the writer thread, None = stop
+        self.writer = None
         self.connected = False
         self.last_connect_attempt = 0
 
     def connect(self):
         if time.time() - self.last_connect_attempt < 5: return
         self.last_connect_attempt = time.time()
-        try:
+        with self.lock:
+            try:
+                if self.ser: self.ser.close()
+                # Output-only channel, so reads never need to block
+                self.ser = serial.Serial(self.port, self.baud, timeout=0)
+                try:
+                    # ASYNC_LOW_LATENCY: 1 ms FTDI latency timer instead of 16 ms (POSIX only)
+                    self.ser.set_low_latency_mode(True)
+                except (OSError, AttributeError, NotImplementedError, ValueError):
+                    pass
+                self.connected = True
+                logger.info(f"✅ Hardware Connected: {self.port}")
+            except Exception as e:
+                if self.connected: logger.error(f"❌ Hardware Lost: {e}")
+                self.connected = False
+
+    def start(self):
+        self.writer = threading.Thread(target=self._serial_writer, name="serial-writer", daemon=True)
+        self.writer.start()
+
+    def stop(self):
+        self.queue.put(None)
+        if self.writer: self.writer.join(timeout=1.0)
+        with self.lock:
             if self.ser: self.ser.close()
-            self.ser = serial.Serial(self.port, self.baud, timeout=0.1)
-            self.connected = True
-            logger.info(f"✅ Hardware Connected: {self.port}")
-        except Exception as e:
-            if self.connected: logger.error(f"❌ Hardware Lost: {e}")
-            self.connected = False
 
+    def _serial_writer(self):
+        # Single long-lived writer: drains everything queued in one pass, but each frame is
+        # written on its own with an RTU silent interval after it so the slave can delimit them
+        while True:
+            frames = [self.queue.get()]
+            while not self.queue.empty(): frames.append(self.queue.get_nowait())
+            if None in frames: return
+            for frame in frames:
+                with self.lock:
+                    if not self.connected: break # Board state is resent after reconnect
+                    try:
+                        self.ser.write(frame)
+                        self.ser.flush() # tcdrain: wait until the frame has left the UART
+                    except:
+                        self.connected = False
+                        break
+                time.sleep(self.frame_gap) # On the writer thread, never on the event loop
+
+    @staticmethod
+    def relay_frame(relay_idx, state):
+        frame = (_RELAY_ON if state else _RELAY_OFF).get(relay_idx)
+        return frame or _coil_frame(relay_idx, 0xFF00 if state else 0x0000)
+
+    # Non-blocking: frames are handed to the writer thread
     def send_relay(self, relay_idx, state):
+        if self.connected: self.queue.put_nowait(self.relay_frame(relay_idx, state))
+
+    def send_relays(self, pairs):
         if not self.connected: return
-        try:
-            data = 0xFF00 if state else 0x0000
-            packet = struct.pack('>BBHH', 0xFF, 0x05, relay_idx, data)
-            crc = 0xFFFF
-            for byte in packet:
-                crc ^= byte
-                for _ in range(8):
-                    crc = (crc >> 1) ^ 0xA001 if (crc & 1) else (crc >> 1)
-            final = packet + struct.pack('<H', crc)
-            self.ser.write(final)
-        except:
-            self.connected = False
+        for idx, state in pairs: self.queue.put_nowait(self.relay_frame(idx, state))
 
 hw = HexEngine(SERIAL_PORT, BAUD_RATE)
 
@@ -128,154 +319,270 @@ hw = HexEngine(SERIAL_PORT, BAUD_RATE)
 async def control_loop():
     logger.info("🚀 BAS Logic Engine Started")
     hw.connect()
+    interval = POLL_RATE
+    next_tick = time.monotonic()
+    last_tick = next_tick - POLL_RATE
     
     while True:
         try:
-            if not hw.connected: hw.connect()
-            current_time = datetime.now()
+            if not hw.connected:
+                hw.connect()
+                # Board state is unknown after a (re)connect, force a full resend
+                for u in sys.units.values(): u.pop("_last_outputs", None)
+            # One clock read per tick, reused for the schedule and every timestamp below
+            t = time.time()
+            lt = time.localtime(t)
             
             # --- 1. Global Schedule Calculation ---
             # Determine if building should be occupied based on "sch_default"
-            day_idx = current_time.weekday() # 0=Mon
+            day_idx = lt.tm_wday # 0=Mon
             sched = sys.schedules.get("sch_default")
             calc_occupied = False
             
             if sched and str(day_idx) in sched["days"]:
                 d = sched["days"][str(day_idx)]
-                if d["enabled"]:
-                    try:
-                        s_h, s_m = map(int, d["start"].split(":"))
-                        e_h, e_m = map(int, d["end"].split(":"))
-                        now_min = current_time.hour * 60 + current_time.minute
-                        start_min = s_h * 60 + s_m
-                        end_min = e_h * 60 + e_m
-                        
-                        # Check if within range (inclusive start, exclusive end)
-                        if start_min <= now_min < end_min:
-                            calc_occupied = True
-                    except ValueError:
-                        pass # Ignore schedule format errors
+                now_min = lt.tm_hour * 60 + lt.tm_min
+                # Check if within range (inclusive start, exclusive end)
+                if d["enabled"] and d["_start_min"] <= now_min < d["_end_min"]:
+                    calc_occupied = True
             
             # Update global state so Dashboard sees it
             sys.global_occupied = calc_occupied
 
-            # --- 2. Process Units ---
-            for uid, u in sys.units.items():
+            # Simulation advances by elapsed time, not tick count, so idle polling doesn't slow it.
+            # Wake-triggered ticks inside the poll period only recompute outputs: a sub-period step
+            # would be lost to the 0.1 F rounding and would crowd the history window.
+            now_tick = time.monotonic()
+            advance = now_tick - last_tick >= POLL_RATE * 0.9 # Tolerate scheduler jitter
+            sim_scale = min(now_tick - last_tick, IDLE_POLL_RATE) / POLL_RATE if advance else 0.0
+            if advance: last_tick = now_tick
+            if sys.units_stale or len(sys.units) != len(sys.unit_state.ids): sys.refresh_unit_state()
+            st = sys.unit_state
+            e_stop = sys.global_settings["emergency_stop"]
+
+            # --- 2. Physics & Control for all units at once (B, C) ---
+            all_req_fan, all_req_cool, all_req_heat, sp_c, sp_h, nearest = control_step(
+                st.temp, st.resid, st.sp_occ_cool, st.sp_occ_heat, st.sp_unocc_cool, st.sp_unocc_heat,
+                calc_occupied, st.out_cool, st.out_heat, e_stop, sim_scale)
+
+            # --- 3. Process Units ---
+            # Arrays unboxed to Python lists once; per-unit dicts bound to locals below
+            out_cool, out_heat = [], []
+            for uid, u, temp, sp_cool, sp_heat, req_fan, req_cool, req_heat in zip(
+                    sys.units, sys.units.values(), st.temp.tolist(), sp_c.tolist(), sp_h.tolist(),
+                    all_req_fan.tolist(), all_req_cool.tolist(), all_req_heat.tolist()):
+                out = u["outputs"]
                 # A. Apply Occupancy
                 u["is_occupied"] = calc_occupied
 
-                # B. Physics Simulation
-                sim_change = 0.05
-                if u["outputs"]["cool"]: sim_change -= 0.3
-                if u["outputs"]["heat"]: sim_change += 0.4
-                u["temp"] += sim_change
-                u["temp"] = round(u["temp"], 1)
-
-                # C. Control Logic
-                sp_cool = u["setpoints"]["occ_cool"] if u["is_occupied"] else u["setpoints"]["unocc_cool"]
-                sp_heat = u["setpoints"]["occ_heat"] if u["is_occupied"] else u["setpoints"]["unocc_heat"]
-                
-                req_cool = u["temp"] > sp_cool + 1.0
-                req_heat = u["temp"] < sp_heat - 1.0
-                # Fan logic: On if occupied OR if heating/cooling is needed
-                req_fan = u["is_occupied"] or req_cool or req_heat
-
-                if sys.global_settings["emergency_stop"]:
-                    req_cool = req_heat = req_fan = False
-                    u["state"] = "EMERGENCY STOP"
-                else:
-                    if req_cool: u["state"] = "COOLING"
-                    elif req_heat: u["state"] = "HEATING"
-                    elif req_fan: u["state"] = "FAN ONLY"
-                    else: u["state"] = "OFF"
-
-                u["outputs"]["fan"] = req_fan
-                u["outputs"]["cool"] = req_cool
-                u["outputs"]["heat"] = req_heat
-                u["outputs"]["damper"] = 20 if req_fan else 0
+                if e_stop: u["state"] = "EMERGENCY STOP"
+                elif req_cool: u["state"] = "COOLING"
+                elif req_heat: u["state"] = "HEATING"
+                elif req_fan: u["state"] = "FAN ONLY"
+                else: u["state"] = "OFF"
+
+                out["fan"] = req_fan
+                out["cool"] = req_cool
+                out["heat"] = req_heat
+                out["damper"] = 20 if req_fan else 0
 
                 # D. Overrides
                 for k, v in u["overrides"].items():
-                    if k in u["outputs"]: u["outputs"][k] = v
+                    if k in out: out[k] = v
+                fan, cool, heat = bool(out["fan"]), bool(out["cool"]), bool(out["heat"])
+                out_cool.append(cool)
+                out_heat.append(heat)
 
                 # E. Hardware Output (Map RTU_1 to Board)
-                if uid == "rtu_1" and hw.connected:
-                    async with hw.lock:
-                        # Map Fan->0, Cool->1, Heat->2
-                        to_send = [(0, u["outputs"]["fan"]), (1, u["outputs"]["cool"]), (2, u["outputs"]["heat"])]
-                        for r_idx, val in to_send:
-                            val_bool = True if val else False
-                            await asyncio.to_thread(hw.send_relay, r_idx, val_bool)
-                            await asyncio.sleep(0.05)
+                # Only written on change; steady state costs no serial traffic
+                out_vec = (fan, cool, heat, out["damper"])
+                if uid == "rtu_1" and hw.connected and u.get("_last_outputs") != out_vec:
+                    # Map Fan->0, Cool->1, Heat->2
+                    hw.send_relays([(0, fan), (1, cool), (2, heat)])
+                    u["_last_outputs"] = out_vec
 
                 # F. History
-                u["history"].append({"ts": time.time(), "temp": u["temp"], "sp": sp_cool if req_cool else sp_heat, "out": 100 if (req_cool or req_heat) else 0})
-                if len(u["history"]) > 60: u["history"].pop(0)
+                if advance:
+                    u["history"].append({"ts": t, "temp": temp, "sp": sp_cool if req_cool else sp_heat, "out": 100 if (req_cool or req_heat) else 0})
+                    u["_history_dirty"] = True
 
                 # G. Alarms
                 if u["alarms_enabled"]:
-                    if u["temp"] > 85.0:
-                        if not any(a["key"] == "high_temp" for a in u["alarms"]):
-                            u["alarms"].append({"key": "high_temp", "msg": "High Temp Alarm (>85F)", "ts": time.time(), "acked": False})
+                    alarms = u["alarms"]
+                    if temp > 85.0:
+                        if "high_temp" not in alarms:
+                            alarms["high_temp"] = {"key": "high_temp", "msg": "High Temp Alarm (>85F)", "ts": t, "acked": False}
                             sys.add_log("ALARM", u["name"], "High Temp Detected")
-                    elif u["temp"] < 84.0:
+                    elif temp < 84.0:
                         # Auto-clear alarm
-                        original_count = len(u["alarms"])
-                        u["alarms"] = [a for a in u["alarms"] if a["key"] != "high_temp"]
-                        if len(u["alarms"]) < original_count:
+                        if alarms.pop("high_temp", None):
                             sys.add_log("NORMAL", u["name"], "High Temp Returned to Normal")
 
-            await asyncio.sleep(1.0)
+            # Post-override outputs drive next tick's physics
+            st.out_cool[:] = out_cool
+            st.out_heat[:] = out_heat
+
+            sys.invalidate_status()
+
+            # --- 4. Adaptive Poll (with hysteresis) ---
+            if nearest > 3.0: interval = IDLE_POLL_RATE
+            elif nearest <= 1.5: interval = POLL_RATE
         except Exception as e:
             logger.error(f"Loop Error: {e}")
-            await asyncio.sleep(1.0)
+            interval = POLL_RATE
+
+        # Sleep to an absolute monotonic target so tick overhead doesn't accumulate as drift
+        next_tick = max(next_tick + interval, time.monotonic())
+        try: await asyncio.wait_for(sys.wake.wait(), next_tick - time.monotonic())
+        except asyncio.TimeoutError: pass
+        if sys.wake.is_set():
+            sys.wake.clear()
+            next_tick = time.monotonic()
+
+# --- REQUEST MODELS ---
+class ApiReq(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+class LoginReq(ApiReq):
+    username: str
+    password: str
+
+class OverrideReq(ApiReq):
+    key: str
+    value: Optional[Union[bool, float]] = None # None releases the override
+
+class SetpointReq(ApiReq):
+    key: Literal["occ_cool", "occ_heat", "unocc_cool", "unocc_heat"]
+    value: float
+
+class AckReq(ApiReq):
+    alarm_key: str
+
+class AlarmConfigReq(ApiReq):
+    enabled: bool
+
+class LayoutReq(ApiReq):
+    x: float
+    y: float
+
+class ImageReq(ApiReq):
+    image: str
+
+class PinReq(ApiReq):
+    key: str
+    pin: Optional[int] = None
+
+class PointsReq(ApiReq):
+    action: Literal["add", "delete"]
+    name: str
+    reg: Optional[Any] = Field(None, alias="register") # "register" shadows BaseModel.register
+
+class UnitCreateReq(ApiReq):
+    name: str
+    type: str = "RTU"
+    modbus_addr: int = 1
 
 # --- API ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    warm_control_step()
+    hw.start()
     task = asyncio.create_task(control_loop())
     yield
-    if hw.ser: hw.ser.close()
+    hw.stop()
 
 app = FastAPI(lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 
-def get_current_user(request: Request):
-    token = request.cookies.get("session_token")
-    if not token or token not in sys.authenticated_sessions: return None
-    return "admin"
+_SESSION_COOKIE = re.compile(r'(?:^|;)\s*session_token=([^;]*)')
+
+@app.middleware("http")
+async def request_hooks(request: Request, call_next):
+    # Resolve the session once per request from the raw header; handlers read request.state
+    m = _SESSION_COOKIE.search(request.headers.get("cookie", ""))
+    request.state.token = m.group(1) if m else None
+    request.state.user = session_user(request.state.token)
+    response = await call_next(request)
+    # Any write may touch state that /api/status or the control arrays mirror
+    if request.method != "GET":
+        sys.invalidate_status()
+        sys.units_stale = True
+    return response
+
+def unit_view(u):
+    # Alarms are keyed by alarm key internally; the dashboard expects lists.
+    # "_" keys are loop-internal caches and are never exposed.
+    view = {k: v for k, v in u.items() if not k.startswith("_")}
+    view["alarms"] = list(u["alarms"].values())
+    view["history"] = list(u["history"])
+    return view
+
+def schedule_view(sched):
+    # Drop the compiled "_start_min"/"_end_min" bounds; they are loop-internal too
+    days = {i: {k: v for k, v in d.items() if not k.startswith("_")} for i, d in sched.get("days", {}).items()}
+    return {**sched, "days": days}
+
+def status_payload():
+    # Shared part of /api/status, encoded at most once per tick or config change
+    if sys.status_cache is None:
+        if sys.unit_state: sys.unit_state.sync_to_units(sys.units)
+        sys.status_cache = orjson.dumps({
+            "outdoor": 65.0,
+            "global_occupied": sys.global_occupied,
+            "site": sys.site_config,
+            "global_settings": sys.global_settings,
+            "units": [unit_view(u) for u in sys.units.values()],
+            "schedules": [schedule_view(s) for s in sys.schedules.values()],
+        }, option=orjson.OPT_NON_STR_KEYS)
+    return sys.status_cache
+
+def session_user(token):
+    if not token: return None
+    exp = sys.authenticated_sessions.get(token)
+    if exp and exp > time.time(): return "admin"
+    sys.authenticated_sessions.pop(token, None)
+    return None
 
 @app.get("/")
 async def serve_dash(): return FileResponse("index.html")
 
 @app.get("/api/status")
 async def api_status(request: Request):
-    user = get_current_user(request)
-    return {
+    user = request.state.user
+    # Auth state is part of the response, so it is part of the validator too
+    etag = f'"{sys.boot_id}-{sys.rev}-{"a" if user else "g"}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag: return Response(status_code=304, headers=headers)
+    head = orjson.dumps({
         "authenticated": user is not None,
         "username": user or "Guest",
         "role": "admin" if user else "viewer",
-        "outdoor": 65.0,
-        "global_occupied": sys.global_occupied,
-        "site": sys.site_config,
-        "global_settings": sys.global_settings,
-        "units": list(sys.units.values()),
-        "schedules": list(sys.schedules.values()),
-        "users": sys.users if user else []
-    }
+        "users": [{"username": u["username"], "role": u["role"]} for u in sys.users.values()] if user else []
+    })
+    # Splice the per-request fields onto the cached shared object
+    return Response(head[:-1] + b"," + status_payload()[1:], media_type="application/json", headers=headers)
 
 @app.post("/api/login")
-async def api_login(req: dict, response: Response):
-    for u in sys.users:
-        if u["username"] == req.get("username") and u["password"] == req.get("password"):
-            token = f"auth_{int(time.time())}"
-            sys.authenticated_sessions.add(token)
-            response.set_cookie(key="session_token", value=token)
-            return {"status": "ok"}
+async def api_login(req: LoginReq, response: Response):
+    u = sys.users.get(req.username)
+    cand = u or _DUMMY_USER
+    # PBKDF2 takes tens of ms, keep it off the event loop (and the control loop with it)
+    pw_hash = await asyncio.to_thread(hash_password, req.password, cand["salt"])
+    if hmac.compare_digest(cand["hash"], pw_hash) and u:
+        token = secrets.token_urlsafe(32)
+        sessions = sys.authenticated_sessions
+        sessions[token] = time.time() + SESSION_TTL
+        sessions.move_to_end(token)
+        # Evict expired heads, then cap the table size
+        while sessions and next(iter(sessions.values())) <= time.time(): sessions.popitem(last=False)
+        while len(sessions) > MAX_SESSIONS: sessions.popitem(last=False)
+        response.set_cookie(key="session_token", value=token)
+        return {"status": "ok"}
     raise HTTPException(status_code=401, detail="Invalid credentials")
 
 @app.post("/api/logout")
-async def api_logout(response: Response):
+async def api_logout(request: Request, response: Response):
+    sys.authenticated_sessions.pop(request.state.token, None)
     response.delete_cookie("session_token")
     return {"status": "ok"}
 
@@ -295,51 +602,51 @@ async def api_reload():
 @app.post("/api/settings")
 async def api_settings(req: dict):
     sys.global_settings.update(req)
+    sys.wake.set()
     return {"status": "ok"}
 
 # --- UNIT ENDPOINTS ---
 @app.post("/api/unit/{uid}/override")
-async def api_override(uid: str, req: dict):
+async def api_override(uid: str, req: OverrideReq):
     if uid in sys.units:
-        val, key = req.get("value"), req.get("key")
-        if val is None: 
-            if key in sys.units[uid]["overrides"]: del sys.units[uid]["overrides"][key]
-        else: sys.units[uid]["overrides"][key] = val
+        if req.value is None: sys.units[uid]["overrides"].pop(req.key, None)
+        else: sys.units[uid]["overrides"][req.key] = req.value
+        sys.wake.set()
     return {"status": "ok"}
 
 @app.post("/api/unit/{uid}/setpoint")
-async def api_setpoint(uid: str, req: dict):
-    if uid in sys.units: sys.units[uid]["setpoints"][req.get("key")] = req.get("value")
+async def api_setpoint(uid: str, req: SetpointReq):
+    if uid in sys.units:
+        sys.units[uid]["setpoints"][req.key] = req.value
+        sys.wake.set()
     return {"status": "ok"}
 
 @app.post("/api/unit/{uid}/ack")
-async def api_ack(uid: str, req: dict):
-    key = req.get("alarm_key")
-    if uid in sys.units:
-        for a in sys.units[uid]["alarms"]:
-            if a["key"] == key: a["acked"] = True
+async def api_ack(uid: str, req: AckReq):
+    if uid in sys.units and req.alarm_key in sys.units[uid]["alarms"]:
+        sys.units[uid]["alarms"][req.alarm_key]["acked"] = True
     return {"status": "ok"}
 
 @app.post("/api/unit/{uid}/alarms/config")
-async def api_alarm_cfg(uid: str, req: dict):
-    if uid in sys.units: sys.units[uid]["alarms_enabled"] = req.get("enabled")
+async def api_alarm_cfg(uid: str, req: AlarmConfigReq):
+    if uid in sys.units: sys.units[uid]["alarms_enabled"] = req.enabled
     return {"status": "ok"}
 
 @app.post("/api/unit/{uid}/layout")
-async def api_layout(uid: str, req: dict):
+async def api_layout(uid: str, req: LayoutReq):
     if uid in sys.units:
-        sys.units[uid]["x"] = req.get("x")
-        sys.units[uid]["y"] = req.get("y")
+        sys.units[uid]["x"] = req.x
+        sys.units[uid]["y"] = req.y
     return {"status": "ok"}
 
 @app.post("/api/unit/{uid}/image")
-async def api_u_img(uid: str, req: dict):
-    if uid in sys.units: sys.units[uid]["image"] = req.get("image")
+async def api_u_img(uid: str, req: ImageReq):
+    if uid in sys.units: sys.units[uid]["image"] = req.image
     return {"status": "ok"}
 
 @app.post("/api/unit/{uid}/pin")
-async def api_pin(uid: str, req: dict):
-    if uid in sys.units: sys.units[uid]["pins"][req.get("key")] = req.get("pin")
+async def api_pin(uid: str, req: PinReq):
+    if uid in sys.units: sys.units[uid]["pins"][req.key] = req.pin
     return {"status": "ok"}
 
 @app.post("/api/unit/{uid}/net")
@@ -348,12 +655,10 @@ async def api_net(uid: str, req: dict):
     return {"status": "ok"}
 
 @app.post("/api/unit/{uid}/points")
-async def api_points(uid: str, req: dict):
+async def api_points(uid: str, req: PointsReq):
     if uid in sys.units:
-        action, name, val = req.get("action"), req.get("name"), req.get("register")
-        if action == "add": sys.units[uid]["custom_sensors"][name] = val
-        elif action == "delete": 
-            if name in sys.units[uid]["custom_sensors"]: del sys.units[uid]["custom_sensors"][name]
+        if req.action == "add": sys.units[uid]["custom_sensors"][req.name] = req.reg
+        else: sys.units[uid]["custom_sensors"].pop(req.name, None)
     return {"status": "ok"}
 
 # --- ADMIN ENDPOINTS ---
@@ -363,17 +668,17 @@ async def update_site(req: dict):
     return {"status": "ok"}
 
 @app.post("/api/units")
-async def create_unit(req: dict):
+async def create_unit(req: UnitCreateReq):
     new_id = f"unit_{int(time.time())}"
     sys.units[new_id] = {
-        "id": new_id, "name": req.get("name"), "type": req.get("type", "RTU"),
+        "id": new_id, "name": req.name, "type": req.type,
         "state": "OFF", "temp": 72.0, "dat_val": None, "secondary_val": None, "secondary_type": "",
         "setpoints": {"occ_cool":74,"occ_heat":68,"unocc_cool":80,"unocc_heat":60},
         "outputs": {"fan":False,"cool":False,"heat":False, "damper": 0},
-        "inputs": {}, "overrides": {}, "alarms": [], "alarms_enabled": True, 
-        "history": [], "is_occupied": False, "is_simulating": False,
+        "inputs": {}, "overrides": {}, "alarms": {}, "alarms_enabled": True, 
+        "history": deque(maxlen=60), "is_occupied": False, "is_simulating": False,
         "pins": {}, "custom_sensors": {}, "custom_sensor_values": {},
-        "modbus_addr": req.get("modbus_addr", 1), "image": "", "x": 50, "y": 50
+        "modbus_addr": req.modbus_addr, "image": "", "x": 50, "y": 50
     }
     return {"status": "ok"}
 
@@ -384,16 +689,22 @@ async def del_unit(uid: str):
 
 @app.post("/api/schedules")
 async def save_sched(req: dict):
-    sys.schedules[req.get("id")] = req
+    sys.schedules[req.get("id")] = compile_schedule(req)
+    sys.wake.set()
     return {"status": "ok"}
 
 @app.get("/api/history/{uid}")
 async def api_history(uid: str):
-    if uid in sys.units: return sys.units[uid]["history"]
-    return []
+    if uid not in sys.units: return []
+    u = sys.units[uid]
+    # Re-encoded only after the loop appends a new sample
+    if u.get("_history_dirty", True):
+        u["_history_bytes"] = orjson.dumps(list(u["history"]))
+        u["_history_dirty"] = False
+    return Response(u["_history_bytes"], media_type="application/json")
 
 @app.get("/api/logs")
-async def api_logs(): return sys.logs
+async def api_logs(): return list(sys.logs)
 
 @app.get("/api/platform")
 async def api_platform():